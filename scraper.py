@@ -1,16 +1,26 @@
 
 import asyncio
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from itertools import count
+import logging
+import math
+import random
+import re
 import sqlite3
-from urllib.parse import urlparse, urljoin
+import threading
+from urllib.parse import urljoin
 from uuid import UUID
 
 import aiohttp
-from logbook import StderrHandler as StderrLogger, error, notice
-from lxml.html import document_fromstring
+from lxml.etree import XPath
+from lxml.html import HTMLParser, document_fromstring
 import uvloop
 
 base_url = 'http://www.data.gov.cy/'
+concurrency = 16
+rescrape_after = timedelta(days=7)
 
 labels = (('Πηγή Ενημέρωσης:', 'source'),
           ('Χρέωση:', 'fee'),
@@ -30,110 +40,235 @@ fields = ('identifier',
           *(l for _, l in labels),
           'meta__list_url',
           'meta__last_updated')
+label_map = dict(labels)
+unid_pattern = re.compile(r'[0-9a-f]{32}')
 
+row_xpath = XPath('''\
+//font[@class = "datasetresults"]
+/following-sibling::table[1]/tr[position() > 1]''')
+row_formats_xpath = XPath('.//*[starts-with(@class, "format-box")]')
+# Plain strings suffice for our purposes; 'smart' strings keep a reference
+# back to the tree and would have to be created for every result
+next_page_xpath = XPath('//a[contains(string(.), "Επόμενη")]/@href',
+                        smart_strings=False)
+base_href_xpath = XPath('//base/@href', smart_strings=False)
+section_xpath = XPath('//div[@class = "AccordionPanelTab"]/a/@onclick',
+                      smart_strings=False)
+total_xpath = XPath('''\
+normalize-space(substring-before(//span[contains(string(.), "datasets")],
+                                 "datasets"))''', smart_strings=False)
+
+# Pages are parsed on `executor`'s threads, and an lxml parser can only be
+# used by one thread at a time
+parsers = threading.local()
+
+log = logging.getLogger(__name__)
 loop = uvloop.new_event_loop()
+executor = ThreadPoolExecutor(max_workers=4)
+
+
+def parse_html(body):
+    try:
+        parser = parsers.parser
+    except AttributeError:
+        parser = parsers.parser = HTMLParser(encoding='utf-8')
+    # Links aren't made absolute here; the few that we need are resolved
+    # against `get_base` by the scrapers
+    return document_fromstring(body, parser=parser)
+
+
+def make_identifier(item_url):
+    # Equivalent to `UUID(hex=unid, version=4).hex`, which sets the version
+    # nibble and the variant bits, but without constructing the UUID
+    unid = item_url.partition('?')[0].rpartition('/')[-1].lower()
+    if not unid_pattern.fullmatch(unid):
+        return UUID(hex=unid, version=4).hex
+    return unid[:12] + '4' + unid[13:16] + '89ab'[int(unid[16], 16) & 3] + \
+        unid[17:]
+
+
+def get_retry_delay(e, attempt):
+    retry_after = (getattr(e, 'headers', None) or {}).get('Retry-After')
+    delay = None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) -
+                         datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    if delay is not None and math.isfinite(delay):
+        # Every request waits on this, so don't let the server stall us
+        # for longer than five minutes at a time
+        return min(300, max(0, delay))
+    return min(60, 5 * 2 ** attempt) + random.uniform(0, 1)
+
+
+def get_base(html):
+    # What `make_links_absolute(base_url)` would resolve links against,
+    # which takes a <base href> into account
+    base_hrefs = base_href_xpath(html)
+    return urljoin(base_url, base_hrefs[-1]) if base_hrefs else base_url
+
+
+def find_text(el, path):
+    found = el.find(path)
+    return '' if found is None else found.text_content()
 
 
-def parse_html(text):
-    html = document_fromstring(text.replace('<?xml version="1.0" encoding="UTF-8"?>', ''))
-    html.make_links_absolute(base_url)
-    return html
+def extract_metadata(html):
+    metadata = {}
+    for b in html.iter('b'):
+        f = label_map.get(b.text)
+        if f and f not in metadata:     # First match wins, like string()
+            metadata[f] = (b.getparent().text_content()
+                           .replace(b.text, '').strip() or None)
+    return {f: metadata.get(f) for _, f in labels}
 
 
-async def scrape_item(formats, tag, item_url, list_url,
+def extract_item(body):
+    html = parse_html(body)
+    return {'title': find_text(html, './/*[@class="datasethead"]').strip(),
+            **extract_metadata(html)}
+
+
+def make_row(r, base, list_url):
+    head = r.find('.//a[@class="datasethead"]')
+    href = None if head is None else head.get('href')
+    return (';'.join(filter(None,
+                            (i.text_content().strip() for i in
+                             row_formats_xpath(r))
+                            )) or None,
+            find_text(r, './/*[@class="datasetcat"]').strip(),
+            '' if href is None else urljoin(base, href.strip()),
+            list_url)
+
+
+async def scrape_item(identifier, formats, tag, item_url, list_url,
                       get):
     async with get(item_url) as item_resp:
-        html = parse_html(await item_resp.text())
-    return {'identifier': UUID(hex=urlparse(item_url).path.rpartition('/')[-1],
-                               version=4).hex,
-            'title': html.xpath('string(//*[@class = "datasethead"])').strip(),
+        body = await item_resp.read()
+    return {'identifier': identifier,
             'url': item_url,
             'formats': formats,
             'tag': tag,
-            **{f: (html.xpath('string(//b[text() = "{}"]/..)'
-                              .format(l)).replace(l, '').strip() or None)
-               for l, f in labels},
+            **await loop.run_in_executor(executor, extract_item, body),
             'meta__list_url': list_url}
 
 
-async def scrape_list(url, get):
-    datasets = []
-    while True:
+async def scrape_list(url, section, queue, get):
+    for page in count():
         async with get(url) as list_resp:
-            text = await list_resp.text()
-        html = orig_html = parse_html(text)
+            body = await list_resp.read()
+        rows_html = orig_html = await loop.run_in_executor(executor,
+                                                           parse_html, body)
         # '[Replication or Save Conflict]' warnings add an extra column,
         # complicating the parsing.  The 'Collapse' parameter gets rid of those
         # but it also messes up the pagination (because why wouldn't it),
         # so we're left with having to download the same page twice
-        if '[Replication or Save Conflict]' in text:
-            notice("'[Replication or Save Conflict]' in {}", url)
+        if b'[Replication or Save Conflict]' in body:
+            log.info("'[Replication or Save Conflict]' in %s", url)
             async with get(url + '&Collapse=') as list_resp:
-                html = parse_html(await list_resp.text())
-
-        datasets.extend([
-            (';'.join(filter(None,
-                             (i.text_content().strip() for i in
-                              r.xpath('.//*[starts-with(@class, "format-box")]'))
-                             )) or None,
-             r.xpath('string(.//*[@class = "datasetcat"])').strip(),
-             r.xpath('string(.//a[@class = "datasethead"]/@href)'),
-             url) for r in html.xpath('''\
-//font[@class = "datasetresults"]
-/following-sibling::table[1]/tr[position() > 1]''')])
+                body = await list_resp.read()
+            rows_html = await loop.run_in_executor(executor, parse_html, body)
+
+        base = get_base(rows_html)
+        for i, r in enumerate(row_xpath(rows_html)):
+            await queue.put(((section, page, i), make_row(r, base, url)))
         try:
-            url, = orig_html.xpath('//a[contains(string(.), "Επόμενη")]/@href')
+            url, = next_page_xpath(orig_html)
         except ValueError:
-            return datasets
+            return
+        url = urljoin(get_base(orig_html), url.strip())
 
 
-async def gather_datasets(get):
+async def gather_datasets(get, recent=frozenset()):
     async with get(base_url) as index_resp:
-        html = parse_html(await index_resp.text())
+        body = await index_resp.read()
+    html = await loop.run_in_executor(executor, parse_html, body)
     sections = (urljoin(index_resp.url,
                         l.replace('location.href=', '').strip("'")) for l in
-                html.xpath('//div[@class = "AccordionPanelTab"]/a/@onclick'))
-    datasets = await get.gather(scrape_list(s, get) for s in sections)
-    datasets = await get.gather(scrape_item(*i, get)
-                                for l in datasets for i in l)
-    return (int(html.xpath('string(//span[contains(string(.), "datasets")])')
-                   .replace('datasets', '')
-                   .strip()),
-            datasets)
+                section_xpath(html))
+    # Items are scraped as their list pages come in, rather than after
+    # every last list has been paged through.  The queue is bounded so
+    # that the lists can't run too far ahead of the item workers
+    queue = asyncio.Queue(maxsize=64, loop=loop)
+    datasets = []
+    skipped = 0
+
+    async def scrape_lists():
+        await get.gather(scrape_list(s, n, queue, get)
+                         for n, s in enumerate(sections))
+        for _ in range(concurrency):
+            await queue.put(None)   # Let the item workers know we're done
+
+    async def scrape_items():
+        nonlocal skipped
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            position, row = item
+            identifier = make_identifier(row[2])
+            if identifier in recent:
+                skipped += 1
+                continue
+            datasets.append((position,
+                             await scrape_item(identifier, *row, get)))
+
+    await get.gather([scrape_lists(),
+                      *(scrape_items() for _ in range(concurrency))])
+    # Put the items back in list order, so that with INSERT OR REPLACE the
+    # last listing of a dataset wins, whichever finished scraping last
+    datasets.sort(key=lambda i: i[0])
+    return int(total_xpath(html)), skipped, [d for _, d in datasets]
 
 
 def prepare_getter(loop, session):
     class Get:
+        __slots__ = ('url', 'resp')
+
         event = asyncio.Event(loop=loop)
         event.set()  # Flip the inital state to True
-        semaphore = asyncio.Semaphore(8, loop=loop)
+        semaphore = asyncio.Semaphore(concurrency, loop=loop)
 
         def __init__(self, url):
             self.url = url
 
         async def __aenter__(self):
-            for i in range(3):
+            for attempt in range(3):
                 await self.event.wait()
                 try:
                     async with self.semaphore:
                         self.resp = await session.get(self.url)
+                        if self.resp.status in {429, 503}:
+                            self.resp.close()
+                            raise aiohttp.HttpProcessingError(
+                                code=self.resp.status,
+                                message=self.resp.reason,
+                                headers=self.resp.headers)
                         return self.resp
-                except aiohttp.errors.ClientResponseError as e:
-                    if i == 3:
+                except (aiohttp.errors.ClientResponseError,
+                        aiohttp.HttpProcessingError) as e:
+                    if attempt == 2:
                         raise       # Giving up after the third attempt
                     # Pausing all requests since they're all going to
                     # the same server and are (probably) gonna be
                     # similarly rejected
-                    await self._pause(e)
+                    await self._pause(e, attempt)
 
         async def __aexit__(self, *a):
             self.resp.close()
 
-        async def _pause(self, e):
+        async def _pause(self, e, attempt):
             if self.event.is_set():  # Debounce repeated failures
                 self.event.clear()
-                error('Received {!r} on {}.  Retrying in 5s', e, self.url)
-                await asyncio.sleep(5, loop=loop)
+                delay = get_retry_delay(e, attempt)
+                log.error('Received %r on %s.  Retrying in %.0fs',
+                          e, self.url, delay)
+                await asyncio.sleep(delay, loop=loop)
                 self.event.set()
 
         @staticmethod
@@ -144,26 +279,42 @@ def prepare_getter(loop, session):
 
 
 def main():
-    with StderrLogger(), \
-            aiohttp.ClientSession(loop=loop) as session, \
+    logging.basicConfig(level=logging.INFO)
+    with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=concurrency, use_dns_cache=True, keepalive_timeout=60,
+                loop=loop),
+            loop=loop) as session, \
             sqlite3.connect('data.sqlite') as conn:
-        reported_total, datasets = loop\
-            .run_until_complete(gather_datasets(prepare_getter(loop, session)))
-        now = datetime.now().isoformat()
+        # data.sqlite is published as is, so it's kept in rollback-journal
+        # mode (undoing WAL, should a previous run have switched to it)
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA temp_store = MEMORY')
         conn.execute('''\
 CREATE TABLE IF NOT EXISTS data
 (identifier UNIQUE, title, url, formats, tag, source, fee, processing_level,
  release_date, license, update_frequency, reporting_period,
  geographic_coverage, 'contact_point/name', 'contact_point/email',
  meta__list_url, meta__last_updated)''')
+        # Datasets scraped within `rescrape_after` are left as they are
+        recent = {i for i, in conn.execute('''\
+SELECT identifier FROM data WHERE meta__last_updated > ?''',
+            ((datetime.now() - rescrape_after).isoformat(),))}
+        reported_total, skipped_total, datasets = loop\
+            .run_until_complete(gather_datasets(prepare_getter(loop, session),
+                                                recent))
+        now = datetime.now().isoformat()
         insert_total = conn.executemany('''\
 INSERT OR REPLACE INTO data
 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-            ((*(i for _, i in sorted(d.items(),
+            [(*(i for _, i in sorted(d.items(),
                                      key=lambda i: fields.index(i[0]))), now)
-             for d in datasets)).rowcount
-        notice('Inserted {} datasets; {} are reported to exist',
-               insert_total, reported_total)
+             for d in datasets]).rowcount
+        log.info('Inserted %s datasets and skipped %s scraped recently; '
+                 '%s are reported to exist',
+                 insert_total, skipped_total, reported_total)
+    conn.close()
 
 if __name__ == '__main__':
     main()